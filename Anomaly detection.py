@@ -1,17 +1,46 @@
+from datetime import datetime
+from types import MappingProxyType
+from typing import Dict, Hashable, List, Any, Mapping, Optional, Tuple
 import numpy as np
-from typing import Dict, List, Any
 from src.utils.logging import setup_logger
 from src.monitoring.metrics import MetricsCollector
+from src.monitoring.anomaly_kernels import scan_orders
 
 logger = setup_logger(__name__)
 
+# Shared read-only stand-in for a metric group the collector did not return
+_EMPTY = MappingProxyType({})
+
+# Minimum cached samples before the median/MAD rule replaces the mean-change rule
+HAMPEL_MIN_SAMPLES = 6
+# Scales MAD to a standard-deviation estimate for normally distributed data
+MAD_SCALE = 1.4826
+
+def _hampel_limit(mad: float, k: float = 3.0) -> float:
+    """Hampel test bound: values more than k scaled MADs from the median are outliers"""
+    return k * MAD_SCALE * mad
+
 class AnomalyDetector:
-    def __init__(self, metrics_collector: MetricsCollector):
+    # Message templates, formatted only when a rule fires
+    _MSG_ORDER_VOLUME = "Order volume below threshold: {} orders"
+    _MSG_ORDER_VALUE = "Unusual change in average order value: {:.2%}"
+    _MSG_PROCESSING_TIME = "High transaction processing time: {}s"
+    _MSG_TRANSACTION_FAILURES = "High transaction failure rate: {:.2%}"
+    _MSG_INVENTORY_SYNC = "High ratio of stale inventory items: {:.2%}"
+    _MSG_SYNC_DELAY = "Inventory sync delayed by {}s"
+
+    def __init__(self, metrics_collector: MetricsCollector,
+                 history_sample_size: Optional[int] = None):
         self.metrics_collector = metrics_collector
+        # Cap on history values fed to the median/MAD test; None uses the whole window
+        self.history_sample_size = history_sample_size
+        # Latest (cache version, average) per (metric_type, field)
+        self._hist_avg_memo: Dict[Tuple[str, str], Tuple[Hashable, Optional[float]]] = {}
         self.thresholds = {
             'orders': {
                 'min_hourly_orders': 10,
                 'max_order_value_change': 0.3,
+                'order_value_mad_k': 3.0,
                 'min_unique_customers': 5
             },
             'transactions': {
@@ -23,113 +52,199 @@ class AnomalyDetector:
                 'max_sync_delay': 300  # seconds
             }
         }
+        
+        # Flatten thresholds once so checks avoid nested dict lookups per call
+        self._min_hourly_orders = self.thresholds['orders']['min_hourly_orders']
+        self._max_order_value_change = self.thresholds['orders']['max_order_value_change']
+        self._order_value_mad_k = self.thresholds['orders']['order_value_mad_k']
+        self._max_processing_time = self.thresholds['transactions']['max_processing_time']
+        self._max_failure_rate = self.thresholds['transactions']['max_failure_rate']
+        self._max_stale_items_ratio = self.thresholds['inventory']['max_stale_items_ratio']
+        self._max_sync_delay = self.thresholds['inventory']['max_sync_delay']
+
+        # Anomaly prototypes: type and severity are fixed per rule, only the message varies
+        self._proto_order_volume = {'type': 'order_volume', 'severity': 'high', 'message': ''}
+        self._proto_order_value = {'type': 'order_value', 'severity': 'medium', 'message': ''}
+        self._proto_processing_time = {'type': 'processing_time', 'severity': 'high', 'message': ''}
+        self._proto_transaction_failures = {'type': 'transaction_failures', 'severity': 'critical', 'message': ''}
+        self._proto_inventory_sync = {'type': 'inventory_sync', 'severity': 'medium', 'message': ''}
+        self._proto_sync_delay = {'type': 'sync_delay', 'severity': 'high', 'message': ''}
 
-    def detect_pipeline_issues(self, metrics: Dict[str, Any]) -> List[Dict[str, Any]]:
-        """Detect anomalies in pipeline metrics"""
+    def detect_pipeline_issues(self, metrics: Dict[str, Any],
+                               now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """Detect anomalies in pipeline metrics as of `now` (defaults to the current time)"""
+        if now is None:
+            now = datetime.now()
         anomalies = []
         
-        # Check order metrics
-        order_anomalies = self._check_order_anomalies(metrics.get('order_volume', {}))
-        anomalies.extend(order_anomalies)
+        # Each check appends into the shared result list
+        # Collector methods return None on failure, so treat falsy groups as empty
+        self._check_order_anomalies(metrics.get('order_volume') or _EMPTY, anomalies)
+        self._check_transaction_anomalies(metrics.get('payment_processing') or _EMPTY, anomalies)
+        self._check_inventory_anomalies(metrics.get('inventory_updates') or _EMPTY, now, anomalies)
         
-        # Check transaction metrics
-        transaction_anomalies = self._check_transaction_anomalies(
-            metrics.get('payment_processing', {})
-        )
-        anomalies.extend(transaction_anomalies)
+        return anomalies
+
+    def detect_batch(self, order_counts: np.ndarray,
+                     avg_order_values: np.ndarray) -> List[List[Dict[str, Any]]]:
+        """Detect order anomalies over a batch of probes (backfill / historical replay).
+
+        Each probe is judged against the current cached window with the same
+        rule live detection would apply now (median/MAD, or the mean-change
+        fallback); NaN average order values are skipped like NULLs.
+        """
+        counts = np.asarray(order_counts, dtype=np.float64)
+        avgs = np.asarray(avg_order_values, dtype=np.float64)
+        reference = self._order_value_reference()
+        center, limit = reference if reference is not None else (np.nan, np.nan)
         
-        # Check inventory metrics
-        inventory_anomalies = self._check_inventory_anomalies(
-            metrics.get('inventory_updates', {})
-        )
-        anomalies.extend(inventory_anomalies)
+        fired = scan_orders(counts, avgs, self._min_hourly_orders, center, limit)
         
-        return anomalies
+        results = []
+        for i in range(fired.shape[0]):
+            anomalies = []
+            if fired[i, 0]:
+                anomaly = self._proto_order_volume.copy()
+                anomaly['message'] = self._MSG_ORDER_VOLUME.format(int(counts[i]))
+                anomalies.append(anomaly)
+            if fired[i, 1]:
+                change = abs(avgs[i] - center) / abs(center)
+                anomaly = self._proto_order_value.copy()
+                anomaly['message'] = self._MSG_ORDER_VALUE.format(change)
+                anomalies.append(anomaly)
+            results.append(anomalies)
+        
+        return results
 
-    def _check_order_anomalies(self, metrics: Dict[str, Any]) -> List[Dict[str, Any]]:
-        """Check for anomalies in order metrics"""
-        anomalies = []
+    def _check_order_anomalies(self, metrics: Mapping[str, Any],
+                               out: List[Dict[str, Any]]) -> None:
+        """Check for anomalies in order metrics, appending them to `out`"""
+        if not metrics:
+            return
         
-        if metrics.get('order_count', 0) < self.thresholds['orders']['min_hourly_orders']:
-            anomalies.append({
-                'type': 'order_volume',
-                'severity': 'high',
-                'message': f"Order volume below threshold: {metrics.get('order_count')} orders"
-            })
+        order_count = metrics.get('order_count', 0)
+        if order_count < self._min_hourly_orders:
+            anomaly = self._proto_order_volume.copy()
+            anomaly['message'] = self._MSG_ORDER_VOLUME.format(order_count)
+            out.append(anomaly)
             
         # Check for sudden changes in average order value
-        historical_avg = self._get_historical_average('orders', 'avg_order_value')
-        if historical_avg:
-            current_avg = metrics.get('avg_order_value', 0)
-            change = abs(current_avg - historical_avg) / historical_avg
-            
-            if change > self.thresholds['orders']['max_order_value_change']:
-                anomalies.append({
-                    'type': 'order_value',
-                    'severity': 'medium',
-                    'message': f"Unusual change in average order value: {change:.2%}"
-                })
+        current_avg = metrics.get('avg_order_value')
+        if current_avg is not None:
+            change = self._order_value_change(float(current_avg))
+            if change is not None:
+                anomaly = self._proto_order_value.copy()
+                anomaly['message'] = self._MSG_ORDER_VALUE.format(change)
+                out.append(anomaly)
+
+    def _order_value_change(self, current_avg: float) -> Optional[float]:
+        """Relative change in average order value if it is anomalous, else None"""
+        reference = self._order_value_reference()
+        if reference is None:
+            return None
+        center, limit = reference
+        # Compare against the limit; divide only when the rule fires
+        diff = abs(current_avg - center)
+        if diff > limit:
+            return diff / abs(center)
+        return None
+
+    def _order_value_reference(self) -> Optional[Tuple[float, float]]:
+        """(center, limit) for the order-value rule: flag when |value - center| > limit.
+
+        Uses the median and Hampel bound of the cached window when it is long
+        enough to estimate spread, otherwise the mean-change rule. None when
+        there is no usable history.
+        """
+        history = self._get_history('orders', 'avg_order_value')
+        if len(history) >= HAMPEL_MIN_SAMPLES:
+            median = float(np.median(history))
+            mad = float(np.median(np.abs(history - median)))
+            # MAD is 0 when over half the window is identical; that says nothing about spread
+            if mad > 0 and median != 0:
+                return median, _hampel_limit(mad, self._order_value_mad_k)
         
-        return anomalies
+        # Too little history, or no usable spread estimate; fall back to mean change
+        historical_avg = self._get_historical_average('orders', 'avg_order_value')
+        if not historical_avg:
+            return None
+        return historical_avg, self._max_order_value_change * abs(historical_avg)
 
-    def _check_transaction_anomalies(self, metrics: Dict[str, Any]) -> List[Dict[str, Any]]:
-        """Check for anomalies in transaction processing"""
-        anomalies = []
+    def _check_transaction_anomalies(self, metrics: Mapping[str, Any],
+                                     out: List[Dict[str, Any]]) -> None:
+        """Check for anomalies in transaction processing, appending them to `out`"""
+        if not metrics:
+            return
         
-        if metrics.get('avg_processing_time', 0) > self.thresholds['transactions']['max_processing_time']:
-            anomalies.append({
-                'type': 'processing_time',
-                'severity': 'high',
-                'message': f"High transaction processing time: {metrics.get('avg_processing_time')}s"
-            })
+        # AVG() is NULL when no transaction completed in the window
+        processing_time = metrics.get('avg_processing_time') or 0
+        if processing_time > self._max_processing_time:
+            anomaly = self._proto_processing_time.copy()
+            anomaly['message'] = self._MSG_PROCESSING_TIME.format(processing_time)
+            out.append(anomaly)
             
-        total_transactions = metrics.get('failed_transactions', 0) + metrics.get('successful_transactions', 0)
+        failed = metrics.get('failed_transactions', 0)
+        total_transactions = failed + metrics.get('successful_transactions', 0)
         if total_transactions > 0:
-            failure_rate = metrics.get('failed_transactions', 0) / total_transactions
-            if failure_rate > self.thresholds['transactions']['max_failure_rate']:
-                anomalies.append({
-                    'type': 'transaction_failures',
-                    'severity': 'critical',
-                    'message': f"High transaction failure rate: {failure_rate:.2%}"
-                })
-        
-        return anomalies
+            failure_rate = failed / total_transactions
+            if failure_rate > self._max_failure_rate:
+                anomaly = self._proto_transaction_failures.copy()
+                anomaly['message'] = self._MSG_TRANSACTION_FAILURES.format(failure_rate)
+                out.append(anomaly)
 
-    def _check_inventory_anomalies(self, metrics: Dict[str, Any]) -> List[Dict[str, Any]]:
-        """Check for anomalies in inventory synchronization"""
-        anomalies = []
+    def _check_inventory_anomalies(self, metrics: Mapping[str, Any], now: datetime,
+                                   out: List[Dict[str, Any]]) -> None:
+        """Check for anomalies in inventory synchronization, appending them to `out`"""
+        if not metrics:
+            return
         
-        if metrics.get('total_products', 0) > 0:
-            stale_ratio = metrics.get('stale_items', 0) / metrics.get('total_products', 1)
-            if stale_ratio > self.thresholds['inventory']['max_stale_items_ratio']:
-                anomalies.append({
-                    'type': 'inventory_sync',
-                    'severity': 'medium',
-                    'message': f"High ratio of stale inventory items: {stale_ratio:.2%}"
-                })
+        total_products = metrics.get('total_products', 0)
+        stale_items = metrics.get('stale_items', 0)
+        # Compare against a scaled limit; divide only when the rule fires
+        if total_products > 0 and stale_items > self._max_stale_items_ratio * total_products:
+            anomaly = self._proto_inventory_sync.copy()
+            anomaly['message'] = self._MSG_INVENTORY_SYNC.format(stale_items / total_products)
+            out.append(anomaly)
         
         latest_sync = metrics.get('latest_sync')
         if latest_sync:
-            sync_delay = (datetime.now() - latest_sync).total_seconds()
-            if sync_delay > self.thresholds['inventory']['max_sync_delay']:
-                anomalies.append({
-                    'type': 'sync_delay',
-                    'severity': 'high',
-                    'message': f"Inventory sync delayed by {sync_delay}s"
-                })
-        
-        return anomalies
+            sync_delay = (now - latest_sync).total_seconds()
+            if sync_delay > self._max_sync_delay:
+                anomaly = self._proto_sync_delay.copy()
+                anomaly['message'] = self._MSG_SYNC_DELAY.format(sync_delay)
+                out.append(anomaly)
+
+    def _get_history(self, metric_type: str, field: str) -> np.ndarray:
+        """Non-null cached values of a metric over the retention window, oldest first"""
+        buffer = self.metrics_collector.metrics_cache.get(metric_type)
+        if buffer is None:
+            return np.empty(0)
+        values = buffer.column(field)
+        limit = self.history_sample_size
+        if limit and len(values) > limit:
+            # Evenly strided subset of the window bounds detection cost; anchor
+            # the stride at the newest end so the latest values are always kept
+            step = -(-len(values) // limit)
+            values = values[::-step][::-1]
+        return values[~np.isnan(values)]
 
     def _get_historical_average(self, metric_type: str, field: str) -> float:
-        """Calculate historical average for a metric"""
+        """Calculate historical average for a metric, memoized per cache version"""
         try:
-            historical_data = self.metrics_collector.metrics_cache.get(metric_type, [])
-            if not historical_data:
+            buffer = self.metrics_collector.metrics_cache.get(metric_type)
+            if buffer is None:
                 return None
-                
-            values = [m.get(field, 0) for m in historical_data]
-            return np.mean(values)
+            
+            key = (metric_type, field)
+            version = buffer.version
+            memo = self._hist_avg_memo.get(key)
+            if memo is not None and memo[0] == version:
+                return memo[1]
+            
+            average = buffer.mean(field)
+            self._hist_avg_memo[key] = (version, average)
+            return average
             
         except Exception as e:
-            logger.error(f"Error calculating historical average: {str(e)}")
+            logger.error("Error calculating historical average: %s", e)
             return None
@@ -0,0 +1,24 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; kernels fall back to plain Python loops
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+@njit(cache=True)
+def scan_orders(counts, avgs, min_orders, center, limit):
+    """Evaluate the order rules over a batch of hourly probes.
+
+    Returns an (n, 2) boolean matrix: column 0 is the low-volume rule,
+    column 1 the average-order-value rule |avg - center| > limit. Pass a
+    NaN center to disable the value rule; NaN averages never fire.
+    """
+    n = counts.shape[0]
+    out = np.zeros((n, 2), dtype=np.bool_)
+    for i in range(n):
+        out[i, 0] = counts[i] < min_orders
+        out[i, 1] = abs(avgs[i] - center) > limit
+    return out
@@ -1,16 +1,335 @@
-from datetime import datetime, timedelta
-import pandas as pd
-from typing import Dict, Any
+import asyncio
+from decimal import Decimal
+from multiprocessing import resource_tracker, shared_memory
+import os
+import sys
+import tempfile
+import time
+import zlib
+import numpy as np
+from typing import Dict, Any, Hashable, Iterable, Optional, Union
+try:
+    import fcntl
+except ImportError:  # not available on Windows; single-writer is then not enforced
+    fcntl = None
 from src.utils.logging import setup_logger
 
 logger = setup_logger(__name__)
 
+# Retention window of the anomaly-detection cache, in nanoseconds
+CACHE_WINDOW_NS = 24 * 60 * 60 * 10**9
+
+# Numeric fields kept in the anomaly-detection cache for each metric type
+CACHED_FIELDS = {
+    'orders': ('order_count', 'avg_order_value', 'unique_customers'),
+    'transactions': ('avg_processing_time', 'failed_transactions', 'successful_transactions'),
+    'inventory': ('total_products', 'stale_items'),
+}
+
+class MetricBuffer:
+    """Struct-of-arrays window of cached metrics: int64 epoch-ns timestamps, one float64 column per field"""
+
+    def __init__(self, fields: Iterable[str], capacity: int = 64):
+        self.fields = tuple(fields)
+        self.ts = np.empty(capacity, dtype=np.int64)
+        self.cols = {f: np.empty(capacity, dtype=np.float64) for f in self.fields}
+        # Running sum/count of non-null values per field over the window
+        self.sums = dict.fromkeys(self.fields, 0.0)
+        self.counts = dict.fromkeys(self.fields, 0)
+        self.n = 0
+        # Changes whenever the window contents change, for memoizing readers
+        self.version = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def append(self, timestamp: int, metrics: Dict[str, Any]):
+        """Append one entry; timestamps must be non-decreasing"""
+        if self.n == len(self.ts):
+            self._grow()
+        
+        i = self.n
+        self.ts[i] = timestamp
+        for f in self.fields:
+            value = metrics.get(f)
+            if value is None:
+                self.cols[f][i] = np.nan
+                continue
+            value = float(value)
+            self.cols[f][i] = value
+            self.sums[f] += value
+            self.counts[f] += 1
+        self.n += 1
+        self.version += 1
+
+    def evict(self, cutoff: int):
+        """Drop entries with timestamp <= cutoff"""
+        k = int(np.searchsorted(self.ts[:self.n], cutoff, side='right'))
+        if not k:
+            return
+        
+        for f in self.fields:
+            evicted = self.cols[f][:k]
+            valid = ~np.isnan(evicted)
+            self.sums[f] -= float(evicted[valid].sum())
+            self.counts[f] -= int(valid.sum())
+            # Slice the head off; the next _grow compacts the view
+            self.cols[f] = self.cols[f][k:]
+        self.ts = self.ts[k:]
+        self.n -= k
+        self.version += 1
+
+    def column(self, field: str) -> np.ndarray:
+        """Live values of a field, oldest first (NaN where the probe returned NULL)"""
+        return self.cols[field][:self.n]
+
+    def mean(self, field: str) -> Optional[float]:
+        """Mean of the non-null values of a field over the window"""
+        count = self.counts.get(field, 0)
+        return self.sums[field] / count if count else None
+
+    def _grow(self):
+        capacity = max(2 * self.n, 64)
+        self.ts = np.resize(self.ts[:self.n], capacity)
+        for f in self.fields:
+            self.cols[f] = np.resize(self.cols[f][:self.n], capacity)
+
+class SharedRingBuffer:
+    """Fixed-capacity metrics window in shared memory, visible to every worker process.
+
+    Layout: an int64 header (write count, eviction cutoff, capacity, n_fields,
+    field-name hash, ready flag) followed by an int64 timestamp column and a (capacity, n_fields)
+    float64 value matrix.
+
+    Only the single writer (read_only=False) creates the segment. It holds an
+    exclusive lock file for its whole lifetime, initialises the header under
+    that lock and publishes the ready flag last. Read-only workers only attach,
+    waiting up to attach_timeout seconds for a ready segment, and must agree
+    with its layout. close() never removes the segment: a restarted writer
+    reattaches and keeps the window, and readers stay on the same segment.
+    The writer removes it explicitly with unlink().
+    """
+
+    HEADER_FIELDS = 6
+    HEADER_BYTES = HEADER_FIELDS * 8
+    _CAPACITY, _READY = 2, 5
+
+    def __init__(self, name: str, fields: Iterable[str], capacity: int = 2048,
+                 read_only: bool = False, attach_timeout: float = 10.0):
+        self.name = name
+        self.fields = tuple(fields)
+        self.read_only = read_only
+        self.capacity = capacity
+        self._index = {f: i for i, f in enumerate(self.fields)}
+        # Same field count in a different order or naming would silently misread columns
+        fields_hash = zlib.crc32("\0".join(self.fields).encode())
+        self._layout = (capacity, len(self.fields), fields_hash)
+        self.shm = None
+        self._lock_file = None
+        self._header = self._count = self._cutoff = self.ts = self.values = None
+        try:
+            if read_only:
+                self.shm = self._attach_ready(attach_timeout)
+            else:
+                self._lock_file = self._acquire_writer_lock()
+                self.shm = self._open_or_create()
+            self._map()
+        except BaseException:
+            self.close()
+            raise
+
+    def __len__(self) -> int:
+        return int(self._live_rows().sum())
+
+    @property
+    def version(self) -> Hashable:
+        return int(self._count[0]), int(self._cutoff[0])
+
+    def append(self, timestamp: int, metrics: Dict[str, Any]):
+        """Write one entry at the ring head, overwriting the oldest slot when full"""
+        if self.read_only:
+            raise RuntimeError("Cannot append to a read-only shared metrics cache")
+        i = int(self._count[0]) % self.capacity
+        self.values[i] = [np.nan if metrics.get(f) is None else float(metrics[f])
+                          for f in self.fields]
+        self.ts[i] = timestamp
+        # Publish the row only after it is fully written
+        self._count[0] += 1
+
+    def evict(self, cutoff: int):
+        """Hide entries with timestamp <= cutoff from all readers"""
+        self._cutoff[0] = cutoff
+
+    def column(self, field: str) -> np.ndarray:
+        """Live values of a field, oldest first (NaN where the probe returned NULL)"""
+        rows = self._rows()
+        rows = rows[self.ts[rows] > self._cutoff[0]]
+        return self.values[rows, self._index[field]]
+
+    def mean(self, field: str) -> Optional[float]:
+        """Mean of the non-null values of a field over the window"""
+        values = self.column(field)
+        values = values[~np.isnan(values)]
+        return float(values.mean()) if len(values) else None
+
+    def close(self):
+        """Detach from the segment (and release the writer lock); the segment itself stays"""
+        # Drop the array views first; SharedMemory.close() refuses while buffer exports exist
+        self._header = self._count = self._cutoff = self.ts = self.values = None
+        if self.shm is not None:
+            self.shm.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def unlink(self):
+        """Remove the segment; readers still attached keep their mapping until they close"""
+        if self.read_only:
+            raise RuntimeError("Only the writer may remove a shared metrics cache")
+        if sys.version_info < (3, 13):
+            # The handle is untracked (see _open); re-register so unlink's unregister balances
+            resource_tracker.register(self.shm._name, 'shared_memory')
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _acquire_writer_lock(self):
+        lock_file = open(os.path.join(tempfile.gettempdir(), f"{self.name}.lock"), 'a')
+        if fcntl is not None:
+            try:
+                # Released automatically when the file is closed or the process dies
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                raise RuntimeError(f"Shared metrics cache {self.name!r} already has a writer")
+        return lock_file
+
+    def _open_or_create(self) -> shared_memory.SharedMemory:
+        """Writer side, under the lock: reattach to an existing segment or create one"""
+        try:
+            shm = self._open(self.name)
+        except FileNotFoundError:
+            size = self.HEADER_BYTES + self.capacity * (len(self.fields) + 1) * 8
+            shm = self._open(self.name, create=True, size=size)
+
+        header = np.ndarray((self.HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        try:
+            if header[self._READY]:
+                self._check_layout(header)
+            else:
+                # New segment, or a previous writer died before publishing it
+                header[:self._READY] = (0, np.iinfo(np.int64).min) + self._layout
+                header[self._READY] = 1
+        except BaseException:
+            del header
+            shm.close()
+            raise
+        del header
+        return shm
+
+    def _attach_ready(self, timeout: float) -> shared_memory.SharedMemory:
+        """Reader side: wait for the writer to create and publish the segment"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                shm = self._open(self.name)
+            except (FileNotFoundError, ValueError):
+                # Missing, or created but not yet sized by the writer
+                shm = None
+            if shm is not None:
+                header = np.ndarray((self.HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+                try:
+                    ready = bool(header[self._READY])
+                    if ready:
+                        self._check_layout(header)
+                except BaseException:
+                    del header
+                    shm.close()
+                    raise
+                del header
+                if ready:
+                    return shm
+                shm.close()
+            if time.monotonic() >= deadline:
+                raise FileNotFoundError(f"Shared metrics cache {self.name!r} has not been "
+                                        f"published by a writer")
+            time.sleep(0.05)
+
+    def _check_layout(self, header: np.ndarray):
+        layout = tuple(int(v) for v in header[self._CAPACITY:self._READY])
+        if layout[:2] != self._layout[:2]:
+            raise ValueError(f"Shared metrics cache {self.name!r} has capacity/field count "
+                             f"{layout[:2]}, expected {self._layout[:2]}")
+        if layout[2] != self._layout[2]:
+            raise ValueError(f"Shared metrics cache {self.name!r} has different field names "
+                             f"than {self.fields}")
+
+    def _map(self):
+        buf = self.shm.buf
+        self._header = np.ndarray((self.HEADER_FIELDS,), dtype=np.int64, buffer=buf)
+        self._count = self._header[0:1]
+        self._cutoff = self._header[1:2]
+        self.ts = np.ndarray((self.capacity,), dtype=np.int64, buffer=buf,
+                             offset=self.HEADER_BYTES)
+        self.values = np.ndarray((self.capacity, len(self.fields)), dtype=np.float64, buffer=buf,
+                                 offset=self.HEADER_BYTES + self.capacity * 8)
+
+    @staticmethod
+    def _open(name: str, create: bool = False, size: int = 0) -> shared_memory.SharedMemory:
+        """Open a segment without tying its lifetime to this process.
+
+        Segments outlive every handle by design, so no handle stays registered
+        with the resource tracker (which would unlink the segment when the
+        registering process exits). Each open's own registration is undone
+        immediately, which keeps the tracker balanced even when one process
+        holds several handles to the same name.
+        """
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+    def _rows(self) -> np.ndarray:
+        count = int(self._count[0])
+        start = max(count - self.capacity, 0)
+        return np.arange(start, count) % self.capacity
+
+    def _live_rows(self) -> np.ndarray:
+        return self.ts[self._rows()] > self._cutoff[0]
+
 class MetricsCollector:
-    def __init__(self, db_connection=None):
-        self.db = db_connection
-        self.metrics_cache = {}
+    def __init__(self, db_pool=None, shared_cache_name: Optional[str] = None,
+                 shared_cache_capacity: int = 2048, shared_cache_read_only: bool = False):
+        # asyncpg connection pool; each probe acquires its own connection
+        self.db = db_pool
+        self.metrics_cache: Dict[str, Union[MetricBuffer, SharedRingBuffer]] = {}
+        # Read-only workers detect against the shared window but never write to it
+        self.shared_cache_read_only = bool(shared_cache_name) and shared_cache_read_only
+        if shared_cache_name:
+            # Multi-worker deployments share one window per metric type,
+            # written by a single collecting worker
+            try:
+                for metric_type, fields in CACHED_FIELDS.items():
+                    self.metrics_cache[metric_type] = SharedRingBuffer(
+                        f"{shared_cache_name}_{metric_type}", fields, shared_cache_capacity,
+                        read_only=shared_cache_read_only
+                    )
+            except BaseException:
+                # Release the buffers already opened (and their writer locks)
+                self.close()
+                raise
+
+    def close(self, unlink: bool = False):
+        """Detach from shared-memory cache segments; the writer can also remove them"""
+        for buffer in self.metrics_cache.values():
+            if isinstance(buffer, SharedRingBuffer):
+                if unlink and not buffer.read_only:
+                    buffer.unlink()
+                buffer.close()
 
-    def track_hourly_orders(self) -> Dict[str, Any]:
+    async def track_hourly_orders(self) -> Dict[str, Any]:
         """Track hourly order volume and related metrics"""
         try:
             query = """
@@ -19,49 +338,50 @@ class MetricsCollector:
                        COUNT(DISTINCT customer_id) as unique_customers
                 FROM orders
                 WHERE created_at >= NOW() - INTERVAL '1 HOUR'
-                GROUP BY DATE_TRUNC('hour', created_at)
             """
-            results = pd.read_sql(query, self.db)
+            order_count, avg_order_value, unique_customers = await self._fetch_row(query)
             
             metrics = {
-                'timestamp': datetime.now(),
-                'order_count': results['order_count'].iloc[0],
-                'avg_order_value': results['avg_order_value'].iloc[0],
-                'unique_customers': results['unique_customers'].iloc[0]
+                'timestamp': time.time_ns(),
+                'order_count': order_count,
+                'avg_order_value': avg_order_value,
+                'unique_customers': unique_customers
             }
             
-            self._cache_metrics('orders', metrics)
+            self._cache_metrics('orders', metrics, metrics['timestamp'])
             return metrics
             
         except Exception as e:
-            logger.error(f"Error tracking orders: {str(e)}")
+            logger.error("Error tracking orders: %s", e)
             return None
 
-    def monitor_transaction_time(self) -> Dict[str, Any]:
+    async def monitor_transaction_time(self) -> Dict[str, Any]:
         """Monitor payment processing times"""
         try:
             query = """
                 SELECT AVG(EXTRACT(EPOCH FROM (completed_at - created_at))) as avg_processing_time,
-                       COUNT(CASE WHEN status = 'failed' THEN 1 END) as failed_transactions
+                       COUNT(CASE WHEN status = 'failed' THEN 1 END) as failed_transactions,
+                       COUNT(CASE WHEN status <> 'failed' AND completed_at IS NOT NULL THEN 1 END) as successful_transactions
                 FROM transactions
                 WHERE created_at >= NOW() - INTERVAL '1 HOUR'
             """
-            results = pd.read_sql(query, self.db)
+            avg_processing_time, failed_transactions, successful_transactions = await self._fetch_row(query)
             
             metrics = {
-                'timestamp': datetime.now(),
-                'avg_processing_time': results['avg_processing_time'].iloc[0],
-                'failed_transactions': results['failed_transactions'].iloc[0]
+                'timestamp': time.time_ns(),
+                'avg_processing_time': avg_processing_time,
+                'failed_transactions': failed_transactions,
+                'successful_transactions': successful_transactions
             }
             
-            self._cache_metrics('transactions', metrics)
+            self._cache_metrics('transactions', metrics, metrics['timestamp'])
             return metrics
             
         except Exception as e:
-            logger.error(f"Error monitoring transactions: {str(e)}")
+            logger.error("Error monitoring transactions: %s", e)
             return None
 
-    def check_stock_sync(self) -> Dict[str, Any]:
+    async def check_stock_sync(self) -> Dict[str, Any]:
         """Check inventory synchronization status"""
         try:
             query = """
@@ -70,32 +390,54 @@ class MetricsCollector:
                        MAX(last_sync) as latest_sync
                 FROM inventory_status
             """
-            results = pd.read_sql(query, self.db)
+            total_products, stale_items, latest_sync = await self._fetch_row(query)
             
             metrics = {
-                'timestamp': datetime.now(),
-                'total_products': results['total_products'].iloc[0],
-                'stale_items': results['stale_items'].iloc[0],
-                'latest_sync': results['latest_sync'].iloc[0]
+                'timestamp': time.time_ns(),
+                'total_products': total_products,
+                'stale_items': stale_items,
+                'latest_sync': latest_sync
             }
             
-            self._cache_metrics('inventory', metrics)
+            self._cache_metrics('inventory', metrics, metrics['timestamp'])
             return metrics
             
         except Exception as e:
-            logger.error(f"Error checking inventory sync: {str(e)}")
+            logger.error("Error checking inventory sync: %s", e)
             return None
 
-    def _cache_metrics(self, metric_type: str, metrics: Dict[str, Any]):
-        """Cache metrics for anomaly detection"""
-        if metric_type not in self.metrics_cache:
-            self.metrics_cache[metric_type] = []
+    async def collect_all(self) -> Dict[str, Dict[str, Any]]:
+        """Run all probes concurrently and return them keyed for AnomalyDetector"""
+        orders, transactions, inventory = await asyncio.gather(
+            self.track_hourly_orders(),
+            self.monitor_transaction_time(),
+            self.check_stock_sync()
+        )
+        return {
+            'order_volume': orders,
+            'payment_processing': transactions,
+            'inventory_updates': inventory
+        }
+
+    async def _fetch_row(self, query: str) -> tuple:
+        """Run a single-row aggregate query and return the row as a tuple"""
+        async with self.db.acquire() as conn:
+            row = await conn.fetchrow(query)
+        # AVG() and EXTRACT() come back as Decimal; downstream math expects float
+        return tuple(float(v) if isinstance(v, Decimal) else v for v in row)
+
+    def _cache_metrics(self, metric_type: str, metrics: Dict[str, Any], now: Optional[int] = None):
+        """Cache metrics for anomaly detection; timestamps are int epoch nanoseconds"""
+        if self.shared_cache_read_only:
+            return
+        
+        if now is None:
+            now = time.time_ns()
         
-        self.metrics_cache[metric_type].append(metrics)
+        buffer = self.metrics_cache.get(metric_type)
+        if buffer is None:
+            buffer = self.metrics_cache[metric_type] = MetricBuffer(CACHED_FIELDS[metric_type])
+        buffer.append(metrics['timestamp'], metrics)
         
         # Keep last 24 hours of metrics
-        cutoff = datetime.now() - timedelta(hours=24)
-        self.metrics_cache[metric_type] = [
-            m for m in self.metrics_cache[metric_type] 
-            if m['timestamp'] > cutoff
-        ]
+        buffer.evict(now - CACHE_WINDOW_NS)
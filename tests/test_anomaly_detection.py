@@ -0,0 +1,119 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from src.monitoring.anomaly_detection import HAMPEL_MIN_SAMPLES, AnomalyDetector
+from src.monitoring.metrics import MetricsCollector
+
+
+def _detector(history, **kwargs):
+    collector = MetricsCollector()
+    for i, value in enumerate(history):
+        metrics = {
+            'timestamp': i,
+            'order_count': 20,
+            'avg_order_value': value,
+            'unique_customers': 1
+        }
+        collector._cache_metrics('orders', metrics, i)
+    return AnomalyDetector(collector, **kwargs)
+
+
+def _order_value_anomalies(detector, current_avg):
+    anomalies = detector.detect_pipeline_issues(
+        {'order_volume': {'order_count': 20, 'avg_order_value': current_avg}}
+    )
+    return [a for a in anomalies if a['type'] == 'order_value']
+
+
+@pytest.fixture(autouse=True)
+def _warnings_are_errors():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        yield
+
+
+def test_mad_zero_majority_does_not_flag_small_deviation():
+    detector = _detector([100] * 7 + [130])
+
+    assert _order_value_anomalies(detector, 100.5) == []
+
+
+def test_mad_zero_falls_back_to_mean_change():
+    detector = _detector([100] * 7 + [130])
+
+    anomalies = _order_value_anomalies(detector, 200)
+
+    assert len(anomalies) == 1
+    assert anomalies[0]['message'] == "Unusual change in average order value: 92.77%"
+
+
+def test_short_history_uses_mean_change():
+    detector = _detector([90, 110, 100])
+    assert HAMPEL_MIN_SAMPLES > 3
+
+    assert _order_value_anomalies(detector, 125) == []
+    assert len(_order_value_anomalies(detector, 140)) == 1
+
+
+def test_zero_median_falls_back_to_mean_change():
+    # median 0, MAD 0.5: the Hampel ratio would divide by zero
+    detector = _detector([-1, 0, 0, 0, 0, 1, 2, 3])
+
+    anomalies = _order_value_anomalies(detector, 10)
+
+    assert len(anomalies) == 1
+    assert anomalies[0]['message'] == "Unusual change in average order value: 1500.00%"
+
+
+def test_hampel_flags_spike_but_not_noise():
+    detector = _detector([100, 102, 98, 101, 99, 100, 103])
+
+    assert _order_value_anomalies(detector, 104) == []
+    assert len(_order_value_anomalies(detector, 125)) == 1
+
+
+def test_single_earlier_spike_does_not_mask_hampel():
+    # The 1000 spike drags the mean to ~225; median/MAD still sees 100 +- 2
+    detector = _detector([100, 102, 98, 101, 99, 100, 1000, 103])
+
+    assert _order_value_anomalies(detector, 101) == []
+    assert len(_order_value_anomalies(detector, 130)) == 1
+
+
+def test_history_sample_size_keeps_newest_values():
+    history = list(range(1000))
+    detector = _detector(history, history_sample_size=256)
+
+    sample = detector._get_history('orders', 'avg_order_value')
+
+    assert len(sample) <= 256
+    assert sample[-1] == history[-1]
+    assert np.all(np.diff(sample) > 0)
+
+
+def test_history_sample_size_is_a_no_op_for_short_windows():
+    detector = _detector([1, 2, 3], history_sample_size=256)
+
+    np.testing.assert_array_equal(detector._get_history('orders', 'avg_order_value'), [1, 2, 3])
+
+
+@pytest.mark.parametrize("history", [
+    [100, 102, 98, 101, 99, 100, 103],
+    [100] * 7 + [130],
+    [90, 110, 100],
+])
+def test_detect_batch_matches_live_detection(history):
+    detector = _detector(history)
+    counts = [5, 20, 20, 20, 20]
+    avgs = [100.0, 104.0, 125.0, 200.0, float('nan')]
+
+    batch = detector.detect_batch(counts, avgs)
+
+    for count, avg, replayed in zip(counts, avgs, batch):
+        order_volume = {'order_count': count}
+        if not np.isnan(avg):
+            order_volume['avg_order_value'] = avg
+        live = detector.detect_pipeline_issues({'order_volume': order_volume})
+        assert replayed == live
@@ -0,0 +1,118 @@
+import asyncio
+import random
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from src.monitoring.metrics import MetricBuffer, MetricsCollector
+
+FIELDS = ('a', 'b')
+
+
+def _reference_column(rows, field):
+    return np.array([np.nan if r[field] is None else float(r[field]) for _, r in rows])
+
+
+def _reference_mean(rows, field):
+    values = [float(r[field]) for _, r in rows if r[field] is not None]
+    return sum(values) / len(values) if values else None
+
+
+def _assert_matches(buffer, rows):
+    assert len(buffer) == len(rows)
+    for field in FIELDS:
+        np.testing.assert_array_equal(buffer.column(field), _reference_column(rows, field))
+        expected = _reference_mean(rows, field)
+        if expected is None:
+            assert buffer.mean(field) is None
+        else:
+            assert buffer.mean(field) == pytest.approx(expected)
+
+
+def test_metric_buffer_matches_reference_under_random_appends_and_evictions():
+    rng = random.Random(1234)
+    buffer = MetricBuffer(FIELDS, capacity=4)
+    rows = []
+    ts = 0
+
+    for _ in range(5000):
+        if rng.random() < 0.7:
+            ts += rng.randint(0, 3)
+            row = {f: (None if rng.random() < 0.2 else rng.uniform(-100, 100)) for f in FIELDS}
+            buffer.append(ts, row)
+            rows.append((ts, row))
+        else:
+            cutoff = ts - rng.randint(0, 40)
+            buffer.evict(cutoff)
+            rows = [(t, r) for t, r in rows if t > cutoff]
+        _assert_matches(buffer, rows)
+
+
+def test_metric_buffer_evicting_whole_window_resets_stats():
+    buffer = MetricBuffer(FIELDS)
+    for ts in range(100):
+        buffer.append(ts, {'a': ts, 'b': None})
+
+    buffer.evict(99)
+
+    _assert_matches(buffer, [])
+    buffer.append(200, {'a': 5, 'b': 7})
+    _assert_matches(buffer, [(200, {'a': 5, 'b': 7})])
+
+
+def test_metric_buffer_version_changes_on_append_and_evict():
+    buffer = MetricBuffer(FIELDS)
+    versions = [buffer.version]
+    buffer.append(1, {'a': 1, 'b': 1})
+    versions.append(buffer.version)
+    buffer.evict(1)
+    versions.append(buffer.version)
+
+    assert len(set(versions)) == 3
+
+
+class _Connection:
+    def __init__(self, row):
+        self.row = row
+
+    async def fetchrow(self, query):
+        return self.row
+
+
+class _Acquire:
+    def __init__(self, row):
+        self.row = row
+
+    async def __aenter__(self):
+        return _Connection(self.row)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _Pool:
+    def __init__(self, row):
+        self.row = row
+
+    def acquire(self):
+        return _Acquire(self.row)
+
+
+def test_fetch_row_converts_decimals_to_float():
+    collector = MetricsCollector(_Pool((3, Decimal('50.25'), None)))
+
+    row = asyncio.run(collector._fetch_row("SELECT 1"))
+
+    assert row == (3, 50.25, None)
+    assert isinstance(row[1], float)
+
+
+def test_track_hourly_orders_caches_decimal_aggregates():
+    collector = MetricsCollector(_Pool((12, Decimal('80.50'), 7)))
+
+    metrics = asyncio.run(collector.track_hourly_orders())
+
+    assert metrics['order_count'] == 12
+    assert metrics['avg_order_value'] == 80.5
+    assert collector.metrics_cache['orders'].mean('avg_order_value') == 80.5
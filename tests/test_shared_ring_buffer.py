@@ -0,0 +1,232 @@
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+from src.monitoring.metrics import CACHED_FIELDS, MetricsCollector, SharedRingBuffer
+
+HOUR_NS = 3600 * 10**9
+
+READER_SCRIPT = """
+import sys
+from src.monitoring.metrics import MetricsCollector
+collector = MetricsCollector(shared_cache_name=sys.argv[1], shared_cache_capacity=16,
+                             shared_cache_read_only=True)
+print(len(collector.metrics_cache['orders']))
+"""
+
+SAME_PROCESS_SCRIPT = """
+import sys
+from src.monitoring.metrics import MetricsCollector
+writer = MetricsCollector(shared_cache_name=sys.argv[1], shared_cache_capacity=16)
+reader = MetricsCollector(shared_cache_name=sys.argv[1], shared_cache_capacity=16,
+                          shared_cache_read_only=True)
+reader.close()
+writer.close(unlink=True)
+"""
+
+
+def _order_metrics(i):
+    return {
+        'timestamp': i * HOUR_NS,
+        'order_count': i,
+        'avg_order_value': 100.0,
+        'unique_customers': 1
+    }
+
+
+@pytest.fixture
+def shared_name():
+    name = f"test_{uuid.uuid4().hex[:12]}"
+    yield name
+    # Segments outlive their handles by design; remove whatever a test left behind
+    for path in glob.glob(f"/dev/shm/{name}*") + \
+            glob.glob(os.path.join(tempfile.gettempdir(), f"{name}*.lock")):
+        os.remove(path)
+
+
+@pytest.fixture
+def writer(shared_name):
+    collector = MetricsCollector(shared_cache_name=shared_name, shared_cache_capacity=16)
+    yield collector
+    collector.close(unlink=True)
+
+
+def _run_script(script, name):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return subprocess.run([sys.executable, '-c', script, name],
+                          env=env, capture_output=True, text=True, check=True)
+
+
+def _attach_from_subprocess(name):
+    return int(_run_script(READER_SCRIPT, name).stdout.strip())
+
+
+def _reader(name, **kwargs):
+    return SharedRingBuffer(name, CACHED_FIELDS['orders'], 16, read_only=True, **kwargs)
+
+
+def test_reader_process_sees_writer_history(writer, shared_name):
+    for i in range(5):
+        writer._cache_metrics('orders', _order_metrics(i), i * HOUR_NS)
+
+    assert _attach_from_subprocess(shared_name) == 5
+
+
+def test_segment_survives_reader_process_exit(writer, shared_name):
+    for i in range(3):
+        writer._cache_metrics('orders', _order_metrics(i), i * HOUR_NS)
+
+    _attach_from_subprocess(shared_name)
+    _attach_from_subprocess(shared_name)
+
+    reader = _reader(f"{shared_name}_orders")
+    try:
+        assert len(reader) == 3
+    finally:
+        reader.close()
+
+
+def test_reader_close_leaves_segment_and_writer_lock(writer, shared_name):
+    writer._cache_metrics('orders', _order_metrics(0), 0)
+    _reader(f"{shared_name}_orders").close()
+
+    writer._cache_metrics('orders', _order_metrics(1), HOUR_NS)
+    reader = _reader(f"{shared_name}_orders")
+    try:
+        assert len(reader) == 2
+    finally:
+        reader.close()
+    with pytest.raises(RuntimeError, match="already has a writer"):
+        SharedRingBuffer(f"{shared_name}_orders", CACHED_FIELDS['orders'], 16)
+
+
+def test_reader_without_writer_times_out(shared_name):
+    with pytest.raises(FileNotFoundError, match="has not been published"):
+        _reader(f"{shared_name}_orders", attach_timeout=0.1)
+    assert glob.glob(f"/dev/shm/{shared_name}*") == []
+
+
+def test_reader_waits_for_writer(shared_name):
+    attached = []
+    thread = threading.Thread(
+        target=lambda: attached.append(_reader(f"{shared_name}_orders", attach_timeout=5))
+    )
+    thread.start()
+    time.sleep(0.2)
+    writer = SharedRingBuffer(f"{shared_name}_orders", CACHED_FIELDS['orders'], 16)
+    try:
+        thread.join()
+        writer.append(0, _order_metrics(0))
+        assert len(attached[0]) == 1
+    finally:
+        for buffer in attached:
+            buffer.close()
+        writer.unlink()
+        writer.close()
+
+
+def test_reader_ignores_unpublished_segment(shared_name):
+    name = f"{shared_name}_orders"
+    size = SharedRingBuffer.HEADER_BYTES + 16 * (len(CACHED_FIELDS['orders']) + 1) * 8
+    SharedRingBuffer._open(name, create=True, size=size).close()
+
+    with pytest.raises(FileNotFoundError):
+        _reader(name, attach_timeout=0.1)
+
+
+def test_restarted_writer_keeps_window_for_readers(shared_name):
+    name = f"{shared_name}_orders"
+    writer = SharedRingBuffer(name, CACHED_FIELDS['orders'], 16)
+    writer.append(0, _order_metrics(0))
+    reader = _reader(name)
+    writer.close()
+    try:
+        writer = SharedRingBuffer(name, CACHED_FIELDS['orders'], 16)
+        writer.append(HOUR_NS, _order_metrics(1))
+
+        assert len(reader) == 2
+        np.testing.assert_array_equal(reader.column('order_count'), [0, 1])
+    finally:
+        reader.close()
+        writer.unlink()
+        writer.close()
+
+
+def test_second_writer_is_rejected(writer, shared_name):
+    with pytest.raises(RuntimeError, match="already has a writer"):
+        SharedRingBuffer(f"{shared_name}_orders", CACHED_FIELDS['orders'], 16)
+
+
+def test_read_only_collector_does_not_write(writer, shared_name):
+    reader = MetricsCollector(shared_cache_name=shared_name, shared_cache_capacity=16,
+                              shared_cache_read_only=True)
+    try:
+        reader._cache_metrics('orders', _order_metrics(0), 0)
+        writer._cache_metrics('orders', _order_metrics(1), HOUR_NS)
+
+        assert len(reader.metrics_cache['orders']) == 1
+        with pytest.raises(RuntimeError):
+            reader.metrics_cache['orders'].append(0, _order_metrics(0))
+    finally:
+        reader.close()
+
+
+@pytest.mark.parametrize("fields, capacity", [
+    (CACHED_FIELDS['orders'], 32),
+    (CACHED_FIELDS['orders'][:2], 16),
+])
+def test_attach_with_mismatched_layout_is_rejected(writer, shared_name, fields, capacity):
+    with pytest.raises(ValueError, match="capacity/field count"):
+        SharedRingBuffer(f"{shared_name}_orders", fields, capacity, read_only=True)
+
+
+def test_attach_with_reordered_fields_is_rejected(writer, shared_name):
+    fields = tuple(reversed(CACHED_FIELDS['orders']))
+
+    with pytest.raises(ValueError, match="different field names"):
+        SharedRingBuffer(f"{shared_name}_orders", fields, 16, read_only=True)
+
+
+def test_collector_init_failure_releases_opened_buffers(shared_name):
+    # The second cached type already has a writer, so the collector fails part-way
+    metric_types = list(CACHED_FIELDS)
+    held = SharedRingBuffer(f"{shared_name}_{metric_types[1]}", CACHED_FIELDS[metric_types[1]], 16)
+    try:
+        with pytest.raises(RuntimeError, match="already has a writer"):
+            MetricsCollector(shared_cache_name=shared_name, shared_cache_capacity=16)
+
+        first = SharedRingBuffer(f"{shared_name}_{metric_types[0]}",
+                                 CACHED_FIELDS[metric_types[0]], 16)
+        first.close()
+    finally:
+        held.close()
+
+
+def test_unlink_is_explicit_and_writer_only(writer, shared_name):
+    reader = _reader(f"{shared_name}_orders")
+    try:
+        with pytest.raises(RuntimeError, match="Only the writer"):
+            reader.unlink()
+    finally:
+        reader.close()
+
+    buffer = writer.metrics_cache['orders']
+    buffer.unlink()
+    buffer.unlink()
+    assert not os.path.exists(f"/dev/shm/{shared_name}_orders")
+
+
+def test_writer_and_reader_in_one_process_leave_tracker_balanced(shared_name):
+    result = _run_script(SAME_PROCESS_SCRIPT, shared_name)
+
+    assert "KeyError" not in result.stderr
+    assert "leaked" not in result.stderr
+    assert glob.glob(f"/dev/shm/{shared_name}*") == []